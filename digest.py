@@ -10,13 +10,16 @@ Required environment variables:
   ANTHROPIC_API_KEY     — from console.anthropic.com
 """
 
+import io
 import os
-import re
-import json
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 
 import anthropic
+import orjson
+from datasketch import MinHash, MinHashLSH
 from supabase import create_client, Client
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
@@ -30,6 +33,11 @@ CLAUDE_MODEL      = "claude-haiku-4-5-20251001"  # fast + cheap for digest work
 TIME_WINDOW_HOURS = 24
 MAX_PICKS         = 5
 MAX_ARTICLES      = 200  # cap articles sent to Claude per user
+STARRED_LIMIT     = 30   # recent starred titles used as interest signal
+CACHE_TTL_HOURS   = 24   # reuse Claude responses for identical prompts within this window
+DEDUP_THRESHOLD   = 0.8  # Jaccard similarity above which two articles count as the same story
+DEDUP_NUM_PERM    = 128
+MAX_WORKERS       = 8    # users processed concurrently (I/O bound on Supabase + Claude)
 
 
 def get_supabase() -> Client:
@@ -40,128 +48,244 @@ def get_anthropic() -> anthropic.Anthropic:
     return anthropic.Anthropic(api_key=ANTHROPIC_KEY)
 
 
-def fetch_users(sb: Client) -> list[dict]:
-    """Return all users who have at least one active feed."""
-    res = sb.table("feeds").select("user_id").eq("active", True).execute()
-    user_ids = list({row["user_id"] for row in (res.data or [])})
-
-    if not user_ids:
-        return []
-
-    # Get profiles for those users
-    profiles = sb.table("user_profiles").select("*").in_("user_id", user_ids).execute()
-    profile_map = {p["user_id"]: p for p in (profiles.data or [])}
-
-    return [
-        {"user_id": uid, "profile": profile_map.get(uid, {})}
-        for uid in user_ids
-    ]
-
-
-def fetch_user_items(sb: Client, user_id: str) -> list[dict]:
-    """Return recent items from this user's feeds, ordered by score."""
-    cutoff = (datetime.now(timezone.utc) - timedelta(hours=TIME_WINDOW_HOURS)).isoformat()
+def fetch_digest_payload(sb: Client) -> list[dict]:
+    """Return every user with an active feed, with their profile, recent items
+    (ordered by score) and recently starred titles, in a single RPC call."""
+    res = sb.rpc("get_digest_payload", {
+        "hours":         TIME_WINDOW_HOURS,
+        "max_articles":  MAX_ARTICLES,
+        "starred_limit": STARRED_LIMIT,
+    }).execute()
+    return res.data or []
 
-    # Get user's feed IDs
-    feeds_res = sb.table("feeds").select("id").eq("user_id", user_id).eq("active", True).execute()
-    feed_ids  = [f["id"] for f in (feeds_res.data or [])]
-    if not feed_ids:
-        return []
 
-    items_res = sb.table("items") \
-        .select("id, title, url, summary, source_name, category, score, published_at") \
-        .in_("feed_id", feed_ids) \
-        .gte("published_at", cutoff) \
-        .order("score", desc=True) \
-        .limit(MAX_ARTICLES) \
-        .execute()
+# Control characters stripped from user-supplied text (keeps \t, \n, \r)
+_CTRL_TABLE = dict.fromkeys([*range(0x00, 0x09), 0x0b, 0x0c, *range(0x0e, 0x20), 0x7f])
 
-    return items_res.data or []
 
+def sanitise_text(text: str, max_chars: int = 2000) -> str:
+    """Strip control characters and limit length before embedding in prompts."""
+    return text.translate(_CTRL_TABLE)[:max_chars]
 
-def fetch_user_starred(sb: Client, user_id: str, limit: int = 30) -> list[dict]:
-    """Return titles of items the user has recently starred (interest signal)."""
-    res = sb.table("user_state") \
-        .select("item_id") \
-        .eq("user_id", user_id) \
-        .eq("starred", True) \
-        .order("updated_at", desc=True) \
-        .limit(limit) \
-        .execute()
 
-    item_ids = [r["item_id"] for r in (res.data or [])]
-    if not item_ids:
-        return []
+def _minhash(text: str) -> MinHash:
+    """MinHash over character 5-gram shingles of the text."""
+    text = " ".join(text.lower().split())
+    m = MinHash(num_perm=DEDUP_NUM_PERM)
+    m.update_batch([text[i : i + 5].encode() for i in range(max(1, len(text) - 4))])
+    return m
 
-    items = sb.table("items").select("title").in_("id", item_ids).execute()
-    return items.data or []
 
+def dedupe_items(items: list[dict]) -> list[dict]:
+    """Drop near-duplicate articles (e.g. the same wire story on several
+    feeds). Items arrive ordered by score, so the best-scored copy is kept."""
+    lsh  = MinHashLSH(threshold=DEDUP_THRESHOLD, num_perm=DEDUP_NUM_PERM)
+    kept = []
+    for i, item in enumerate(items):
+        m = _minhash(f"{item.get('title') or ''} {(item.get('summary') or '')[:200]}")
+        if lsh.query(m):
+            continue
+        lsh.insert(str(i), m)
+        kept.append(item)
+    return kept
 
-def sanitise_text(text: str, max_chars: int = 2000) -> str:
-    """Strip control characters and limit length before embedding in prompts."""
-    cleaned = re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]", "", text)
-    return cleaned[:max_chars]
 
+# Curator instructions. Identical for every user, so they are sent as the
+# system prompt; only the per-user data in the user message varies.
+STATIC_INSTRUCTIONS = f"""You are a personal news curator. The user message gives you the reader's name, their stated interests, articles they have starred recently (an implicit interest signal) and a numbered list of articles from the last {TIME_WINDOW_HOURS} hours.
 
-def build_prompt(items: list[dict], profile: dict, starred: list[dict]) -> str:
+YOUR TASK:
+1. Write a 2-3 sentence overview of the most important news from the article list. Be specific — name events, people, or themes. Do not be generic.
+
+2. Pick exactly {MAX_PICKS} articles from the list that the reader would find most interesting, based on their stated interests and starred history. For each pick, give a one-sentence reason.
+
+Return your answer by calling the emit_digest tool. Each pick's "index" is the 1-based article number from the article list."""
+
+# Structured-output contract: forcing this tool makes Claude return the digest
+# as already-parsed JSON matching the schema, instead of free text.
+DIGEST_TOOL = {
+    "name": "emit_digest",
+    "description": "Record the news overview and the personalised article picks.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "overview": {
+                "type": "string",
+                "description": "2-3 sentence overview of the most important news.",
+            },
+            "picks": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "index":  {"type": "integer", "minimum": 1},
+                        "reason": {"type": "string"},
+                    },
+                    "required": ["index", "reason"],
+                },
+            },
+        },
+        "required": ["overview", "picks"],
+    },
+}
+
+
+def build_prompt(items: list[dict], profile: dict, starred: list[dict]) -> tuple[list[dict], str]:
+    """Return (system_blocks, user_content) for the Claude request."""
     interests     = sanitise_text((profile.get("interests") or "").strip())
     display_name  = sanitise_text((profile.get("display_name") or "this user").strip(), max_chars=100)
     starred_titles = [sanitise_text(s["title"], max_chars=200) for s in starred]
 
-    # Format article list for Claude
-    articles_text = "\n".join(
-        f"{i+1}. [{item['source_name']}] {item['title']}"
-        + (f" — {item['summary'][:200]}" if item.get("summary") else "")
-        for i, item in enumerate(items)
-    )
-
-    return f"""You are a personal news curator for {display_name}.
-
-USER INTERESTS:
-{interests if interests else "(not specified — use general news judgment)"}
-
-ARTICLES THIS USER HAS STARRED RECENTLY (implicit interest signal):
-{chr(10).join(f'- {t}' for t in starred_titles) if starred_titles else "(none yet)"}
-
-ARTICLES FROM THE LAST {TIME_WINDOW_HOURS} HOURS ({len(items)} total):
-{articles_text}
-
-YOUR TASK:
-1. Write a 2-3 sentence overview of the most important news from this list. Be specific — name events, people, or themes. Do not be generic.
+    system_blocks = [{"type": "text", "text": STATIC_INSTRUCTIONS}]
+
+    # Build the user message in a single buffer rather than joining
+    # per-article strings and copying them again into an outer f-string.
+    buf = io.StringIO()
+    buf.write(f"READER: {display_name}\n\n")
+    buf.write("USER INTERESTS:\n")
+    buf.write(interests if interests else "(not specified — use general news judgment)")
+    buf.write("\n\nARTICLES THIS USER HAS STARRED RECENTLY (implicit interest signal):\n")
+    if starred_titles:
+        for i, title in enumerate(starred_titles):
+            if i:
+                buf.write("\n")
+            buf.write("- ")
+            buf.write(title)
+    else:
+        buf.write("(none yet)")
+    buf.write(f"\n\nARTICLES FROM THE LAST {TIME_WINDOW_HOURS} HOURS ({len(items)} total):\n")
+    for i, item in enumerate(items):
+        if i:
+            buf.write("\n")
+        buf.write(f"{i+1}. [{item['source_name']}] {item['title']}")
+        if item.get("summary"):
+            buf.write(" — ")
+            buf.write(item["summary"][:200])
+    user_content = buf.getvalue()
+
+    return system_blocks, user_content
+
+
+def prompt_key(system_blocks: list[dict], user_content: str) -> str:
+    """SHA-256 over the model, tool schema and full prompt, used as the
+    response cache key."""
+    h = hashlib.sha256(CLAUDE_MODEL.encode())
+    h.update(b"\0" + orjson.dumps(DIGEST_TOOL))
+    for block in system_blocks:
+        h.update(b"\0" + block["text"].encode())
+    h.update(b"\0" + user_content.encode())
+    return h.hexdigest()
+
+
+def _cache_cutoff() -> str:
+    return (datetime.now(timezone.utc) - timedelta(hours=CACHE_TTL_HOURS)).isoformat()
+
+
+def purge_response_cache(sb: Client):
+    """Delete cached Claude responses older than CACHE_TTL_HOURS."""
+    try:
+        sb.table("claude_cache").delete().lt("created_at", _cache_cutoff()).execute()
+    except Exception as e:
+        log.warning(f"Response cache cleanup failed (non-fatal): {e}")
 
-2. Pick exactly {MAX_PICKS} articles from the list that you think {display_name} would find most interesting, based on their stated interests and starred history. For each pick, give a one-sentence reason.
 
-RESPOND IN THIS EXACT JSON FORMAT (no markdown, no preamble):
-{{
-  "overview": "...",
-  "picks": [
-    {{"index": 1, "reason": "..."}},
-    {{"index": 2, "reason": "..."}},
-    {{"index": 3, "reason": "..."}},
-    {{"index": 4, "reason": "..."}},
-    {{"index": 5, "reason": "..."}}
-  ]
-}}
+def get_cached_response(sb: Client, key: str) -> dict | None:
+    """Return a Claude response stored for this prompt within CACHE_TTL_HOURS."""
+    cutoff = _cache_cutoff()
+    try:
+        res = sb.table("claude_cache") \
+            .select("response_json") \
+            .eq("prompt_sha256", key) \
+            .gte("created_at", cutoff) \
+            .limit(1) \
+            .execute()
+    except Exception as e:
+        log.warning(f"  Response cache lookup failed (non-fatal): {e}")
+        return None
+    return res.data[0]["response_json"] if res.data else None
 
-Where "index" is the 1-based article number from the list above."""
 
+def store_cached_response(sb: Client, key: str, result: dict):
+    try:
+        sb.table("claude_cache").upsert({
+            "prompt_sha256": key,
+            "response_json": result,
+            "created_at":    datetime.now(timezone.utc).isoformat(),
+        }).execute()
+    except Exception as e:
+        log.warning(f"  Response cache write failed (non-fatal): {e}")
+
+
+def _raw_result(message):
+    for block in message.content:
+        if block.type == "tool_use" and block.name == DIGEST_TOOL["name"]:
+            return block.input
+    for block in message.content:
+        if block.type == "text":
+            try:
+                return orjson.loads(block.text.strip())
+            except orjson.JSONDecodeError as e:
+                log.error(f"Claude returned invalid JSON: {e}")
+    return None
+
+
+def extract_result(message) -> dict | None:
+    """Return the digest dict from a Claude message (the emit_digest tool
+    input, or failing that a JSON text block), or None if the answer was cut
+    off or does not have the overview/picks shape."""
+    if message.stop_reason == "max_tokens":
+        log.error("Claude response was truncated (max_tokens)")
+        return None
+    result = _raw_result(message)
+    if not (
+        isinstance(result, dict)
+        and isinstance(result.get("overview"), str)
+        and isinstance(result.get("picks"), list)
+    ):
+        log.error("Claude response is missing a valid overview / picks")
+        return None
+    return result
+
+
+def call_claude(
+    client: anthropic.Anthropic,
+    sb: Client,
+    system_blocks: list[dict],
+    user_content: str,
+) -> dict | None:
+    """Return Claude's digest for this prompt, reusing a cached response when an
+    identical prompt was answered recently (cron double-fires, retries)."""
+    key    = prompt_key(system_blocks, user_content)
+    cached = get_cached_response(sb, key)
+    if cached is not None:
+        log.info("  Using cached Claude response")
+        return cached
 
-def call_claude(client: anthropic.Anthropic, prompt: str) -> dict | None:
     try:
         message = client.messages.create(
             model=CLAUDE_MODEL,
             max_tokens=1024,
-            messages=[{"role": "user", "content": prompt}],
+            system=system_blocks,
+            tools=[DIGEST_TOOL],
+            tool_choice={"type": "tool", "name": DIGEST_TOOL["name"]},
+            messages=[{"role": "user", "content": user_content}],
+        )
+        log.info(
+            f"  Claude usage: {message.usage.input_tokens} input, "
+            f"{message.usage.output_tokens} output tokens"
         )
-        text = message.content[0].text.strip()
-        return json.loads(text)
-    except json.JSONDecodeError as e:
-        log.error(f"Claude returned invalid JSON: {e}")
-        return None
     except Exception as e:
         log.error(f"Claude API error: {e}")
         return None
 
+    result = extract_result(message)
+    if result is None:
+        return None
+
+    # Only well-formed digests are cached, so a retry re-asks Claude otherwise
+    store_cached_response(sb, key, result)
+    return result
+
 
 def write_digest(sb: Client, user_id: str, items: list[dict], result: dict):
     """Convert Claude's response into a digest row and write to Supabase."""
@@ -192,38 +316,53 @@ def write_digest(sb: Client, user_id: str, items: list[dict], result: dict):
     }).execute()
 
 
-def main():
-    sb     = get_supabase()
-    claude = get_anthropic()
+def process_user(sb: Client, claude: anthropic.Anthropic, user: dict):
+    """Build and write the digest for a single user."""
+    user_id = user["user_id"]
+    profile = user.get("profile") or {}
+    name    = profile.get("display_name") or user_id[:8]
+    log.info(f"Processing: {name}")
 
-    users = fetch_users(sb)
-    log.info(f"Generating digest for {len(users)} user(s)")
+    items = user.get("items") or []
+    if not items:
+        log.info(f"  No recent items for {name}, skipping")
+        return
 
-    for user in users:
-        user_id = user["user_id"]
-        profile = user["profile"]
-        name    = profile.get("display_name") or user_id[:8]
-        log.info(f"Processing: {name}")
+    items = dedupe_items(items)
+    log.info(f"  {len(items)} articles to summarise for {name}")
+    starred = user.get("starred") or []
+    log.info(f"  {len(starred)} starred articles as interest signal for {name}")
 
-        items = fetch_user_items(sb, user_id)
-        if not items:
-            log.info(f"  No recent items for {name}, skipping")
-            continue
+    system_blocks, user_content = build_prompt(items, profile, starred)
+    result = call_claude(claude, sb, system_blocks, user_content)
 
-        log.info(f"  {len(items)} articles to summarise")
-        starred = fetch_user_starred(sb, user_id)
-        log.info(f"  {len(starred)} starred articles as interest signal")
+    if not result:
+        log.warning(f"  Failed to get digest for {name}")
+        return
 
-        prompt = build_prompt(items, profile, starred)
-        result = call_claude(claude, prompt)
+    write_digest(sb, user_id, items, result)
+    log.info(f"  Digest written for {name}")
 
-        if not result:
-            log.warning(f"  Failed to get digest for {name}")
-            continue
 
-        write_digest(sb, user_id, items, result)
-        log.info(f"  Digest written for {name}")
+def main():
+    sb     = get_supabase()
+    claude = get_anthropic()
+
+    users = fetch_digest_payload(sb)
+    log.info(f"Generating digest for {len(users)} user(s)")
+
+    # Users are independent, so fan out across a bounded pool. The clients
+    # are created once above and shared between threads.
+    def run(user: dict):
+        try:
+            process_user(sb, claude, user)
+        except Exception as e:
+            log.error(f"  Digest failed for {user['user_id'][:8]}: {e}")
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        list(ex.map(run, users))
 
+    purge_response_cache(sb)
     log.info("Done.")
 
 
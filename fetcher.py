@@ -11,12 +11,19 @@ Required environment variables:
 
 import os
 import re
+import time
+import calendar
 import hashlib
 import logging
-import socket
-from datetime import datetime, timezone, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlsplit, urlunsplit, parse_qsl, urlencode
 
 import feedparser
+import httpx
+from lxml import etree
 from supabase import create_client, Client
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
@@ -28,6 +35,33 @@ SUPABASE_KEY = os.environ["SUPABASE_SERVICE_KEY"]
 # Items older than this are ignored
 MAX_AGE_DAYS = 30
 
+# Feeds fetched concurrently (network bound, httpx releases the GIL on I/O)
+MAX_WORKERS  = 16
+HTTP_TIMEOUT = 10  # seconds per feed request
+USER_AGENT   = "RSSKing/1.0"
+
+# ------------------------------------------------------------------
+# Feed XML namespaces
+# ------------------------------------------------------------------
+ATOM_NS    = "{http://www.w3.org/2005/Atom}"
+RSS1_NS    = "{http://purl.org/rss/1.0/}"
+RDF_NS     = "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}"
+DC_NS      = "{http://purl.org/dc/elements/1.1/}"
+CONTENT_NS = "{http://purl.org/rss/1.0/modules/content/}"
+
+# lxml serialises parses that share a parser object, so each fetch worker
+# thread gets its own parser
+_parser_local = threading.local()
+
+
+def _xml_parser() -> etree.XMLParser:
+    parser = getattr(_parser_local, "parser", None)
+    if parser is None:
+        parser = _parser_local.parser = etree.XMLParser(
+            recover=True, huge_tree=False, resolve_entities=False, no_network=True,
+        )
+    return parser
+
 # ------------------------------------------------------------------
 # Scoring constants
 # ------------------------------------------------------------------
@@ -43,11 +77,30 @@ BREAKING_PATTERNS = re.compile(
     r"\b(breaking|urgent|flash|alert|exclusive)\b", re.IGNORECASE
 )
 
+# RSS category tags that mark an editorially promoted item
+PROMOTED_TAGS = frozenset({"featured", "breaking", "top-news", "editors-pick"})
+
+# Runs of HTML tags and whitespace, collapsed to a single space in one pass
+_STRIP_RE = re.compile(r"(?:<[^>]+>|\s)+")
+
 NOISE_KEYWORDS = [
     "sponsored", "advertisement", "buy now", "subscribe now",
     "limited offer", "click here",
 ]
 
+# Title patterns and noise keywords fused into one case-insensitive alternation,
+# so a single C-level scan over title + summary finds both kinds of match
+_SCORE_RE = re.compile(
+    rf"(?P<breaking>{BREAKING_PATTERNS.pattern})"
+    rf"|(?P<noise>{'|'.join(map(re.escape, NOISE_KEYWORDS))})",
+    re.IGNORECASE,
+)
+
+
+# Query parameters that only track the referrer; dropped so the same article
+# shared through different channels dedupes to one URL
+TRACKING_PARAMS = frozenset({"fbclid", "gclid", "mc_cid", "mc_eid", "cmpid"})
+
 
 def get_supabase() -> Client:
     return create_client(SUPABASE_URL, SUPABASE_KEY)
@@ -59,178 +112,400 @@ def fetch_all_active_feeds(sb: Client) -> list[dict]:
     return res.data or []
 
 
-def fetch_existing_urls(sb: Client) -> set[str]:
-    """Return URLs already in the items table (for deduplication)."""
-    res = sb.table("items").select("url").execute()
-    return {row["url"] for row in (res.data or [])}
+def normalise_url(url: str) -> str:
+    """Canonical form of an article URL: lowercased scheme and host, tracking
+    query parameters (utm_* etc.) removed. Plain in-page fragments are
+    dropped, but hashbang / path-style fragments (#!/story/1, #/post/2) are
+    kept because they identify the article on client-routed sites."""
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+    params = parse_qsl(parts.query, keep_blank_values=True)
+    kept   = [
+        (k, v) for k, v in params
+        if not k.lower().startswith("utm_") and k.lower() not in TRACKING_PARAMS
+    ]
+    # Only re-encode when something was dropped, to leave other URLs untouched
+    query    = parts.query if len(kept) == len(params) else urlencode(kept)
+    fragment = parts.fragment if parts.fragment.startswith(("!", "/")) else ""
+    # Only the host is case-insensitive; keep any userinfo exactly as given
+    userinfo, at, hostport = parts.netloc.rpartition("@")
+    netloc   = userinfo + at + hostport.lower()
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path, query, fragment))
+
+
+def url_key(url: str) -> int:
+    """64-bit hash of a (normalised) URL, used as the dedup key in sets."""
+    return int.from_bytes(hashlib.blake2b(url.encode(), digest_size=8).digest(), "big")
 
 
 def score_item(
     item: dict,
     feed: dict,
-    url_feed_count: dict[str, int],
+    url_feed_count: dict[int, int],
+    now_ts: float | None = None,
 ) -> float:
-    """Compute a relevance score for an RSS item."""
+    """Compute a relevance score for an RSS item.
+
+    Pass ``now_ts`` (epoch seconds) when scoring a batch so the clock is read
+    once per run.
+    """
+    if now_ts is None:
+        now_ts = time.time()
     score = 0.0
 
     # Tier weight
     score += TIER_WEIGHTS.get(feed.get("tier", 2), 20)
 
     # Time decay (0–50 points, linear over MAX_AGE_DAYS)
-    published = item.get("_published_dt")
-    if published:
-        age_hours = (datetime.now(timezone.utc) - published).total_seconds() / 3600
-        age_days  = age_hours / 24
+    published_ts = item.get("_published_ts")
+    if published_ts is not None:
+        age_days  = (now_ts - published_ts) / 86400
         decay     = max(0, 1 - age_days / MAX_AGE_DAYS)
         score    += decay * TIME_DECAY_MAX
 
     # Multi-source correlation
-    url = item.get("link", "")
-    if url_feed_count.get(url, 1) >= 3:
+    if url_feed_count.get(item.get("_url_key"), 1) >= 3:
         score += MULTI_SOURCE_BUMP
 
     # RSS metadata tags
-    tags = [t.get("term", "").lower() for t in item.get("tags", [])]
-    if any(t in ("featured", "breaking", "top-news", "editors-pick") for t in tags):
+    if any((t.get("term") or "").lower() in PROMOTED_TAGS for t in item.get("tags", [])):
         score += METADATA_BUMP
 
-    # Title patterns
-    title = item.get("title", "")
-    if BREAKING_PATTERNS.search(title):
+    # Title patterns (title only) and noise penalty (title + summary)
+    title    = item.get("title") or ""
+    combined = title + " " + (item.get("summary") or "")
+    breaking = noise = False
+    for m in _SCORE_RE.finditer(combined):
+        if m.group("breaking") is not None:
+            breaking = breaking or m.end() <= len(title)
+        else:
+            noise = True
+        if breaking and noise:
+            break
+    if breaking:
         score += TITLE_PATTERN_BUMP
-
-    # Noise penalty
-    combined = (title + " " + item.get("summary", "")).lower()
-    if any(kw in combined for kw in NOISE_KEYWORDS):
+    if noise:
         score += KEYWORD_PENALTY
 
     return round(score, 2)
 
 
-def parse_published(entry: dict):
-    """Return a timezone-aware datetime from a feedparser entry, or None."""
+def _parse_date(text: str | None):
+    """Parse an RFC 822 (RSS) or ISO 8601 (Atom) date into a UTC struct_time."""
+    if not text:
+        return None
+    text = text.strip()
+    try:
+        dt = parsedate_to_datetime(text)
+    except (TypeError, ValueError):
+        try:
+            dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    try:
+        return dt.utctimetuple()
+    except OverflowError:  # e.g. 0001-01-01 with a positive offset
+        return None
+
+
+def _resolve(el, href: str | None) -> str:
+    """Resolve a possibly relative link against the element's xml:base (which
+    lxml chains up to the document URL)."""
+    href = (href or "").strip()
+    if not href:
+        return ""
+    return urljoin(el.base, href) if el.base else href
+
+
+def _rss_link(el) -> str:
+    link_el = el.find("link")
+    if link_el is None:
+        link_el = el.find(f"{RSS1_NS}link")
+    if link_el is not None and (link_el.text or "").strip():
+        return _resolve(link_el, link_el.text)
+    # Like feedparser, fall back to a guid unless it is marked as not a permalink
+    guid = el.find("guid")
+    if guid is not None and guid.get("isPermaLink", "true").lower() != "false":
+        return _resolve(guid, guid.text)
+    return ""
+
+
+def _rss_entry(el) -> dict:
+    description = el.findtext("description") or el.findtext(f"{RSS1_NS}description")
+    content     = el.findtext(f"{CONTENT_NS}encoded")
+    return {
+        "title":            el.findtext("title") or el.findtext(f"{RSS1_NS}title") or "",
+        "link":             _rss_link(el),
+        "summary":          description or "",
+        "content":          [{"value": content}] if content else [],
+        "published_parsed": _parse_date(el.findtext("pubDate") or el.findtext(f"{DC_NS}date")),
+        "tags":             [{"term": c.text} for c in el.iterfind("category") if c.text],
+    }
+
+
+def _atom_text(el) -> str:
+    """Text of an Atom text construct; type="xhtml" content lives in child
+    elements, so serialise those instead of reading the direct text."""
+    if el is None:
+        return ""
+    if el.get("type") == "xhtml":
+        return (el.text or "") + "".join(etree.tostring(c, encoding="unicode") for c in el)
+    return el.text or ""
+
+
+def _atom_entry(el) -> dict:
+    link = ""
+    for l in el.iterfind(f"{ATOM_NS}link"):
+        if l.get("rel", "alternate") == "alternate":
+            link = _resolve(l, l.get("href"))
+            break
+    title_el = el.find(f"{ATOM_NS}title")
+    content  = _atom_text(el.find(f"{ATOM_NS}content"))
+    return {
+        "title":            "".join(title_el.itertext()) if title_el is not None else "",
+        "link":             link,
+        "summary":          _atom_text(el.find(f"{ATOM_NS}summary")),
+        "content":          [{"value": content}] if content else [],
+        "published_parsed": _parse_date(
+            el.findtext(f"{ATOM_NS}published") or el.findtext(f"{ATOM_NS}updated")
+        ),
+        "tags":             [{"term": c.get("term")} for c in el.iterfind(f"{ATOM_NS}category") if c.get("term")],
+    }
+
+
+def parse_feed_fast(body: bytes, base_url: str | None = None) -> list[dict] | None:
+    """Parse an RSS 2.0 / RSS 1.0 / Atom document with lxml.
+
+    Returns feedparser-shaped entry dicts (title, link, summary, content,
+    published_parsed, tags), or None when the document is not recognised so
+    the caller can fall back to feedparser. Relative links are resolved
+    against xml:base and then ``base_url`` (the URL the feed was served from).
+    """
+    try:
+        root = etree.fromstring(body, parser=_xml_parser(), base_url=base_url)
+    except etree.XMLSyntaxError:
+        return None
+    if root is None:
+        return None
+
+    if root.tag == "rss":
+        return [_rss_entry(el) for el in root.iterfind("channel/item")]
+    if root.tag == f"{RDF_NS}RDF":
+        return [_rss_entry(el) for el in root.iterfind(f"{RSS1_NS}item")]
+    if root.tag == f"{ATOM_NS}feed":
+        return [_atom_entry(el) for el in root.iterfind(f"{ATOM_NS}entry")]
+    return None
+
+
+def parse_published(entry: dict) -> int | None:
+    """Return the publish time of a parsed entry as UTC epoch seconds, or None."""
     if entry.get("published_parsed"):
         try:
-            t = entry.published_parsed
-            return datetime(*t[:6], tzinfo=timezone.utc)
+            return calendar.timegm(entry["published_parsed"][:9])
         except Exception:
             pass
     return None
 
 
 def summarise(entry: dict, max_chars: int = 500) -> str:
-    """Extract a short plain-text summary from a feedparser entry."""
+    """Extract a short plain-text summary from a parsed entry."""
     text = ""
     if entry.get("summary"):
-        text = entry.summary
+        text = entry["summary"]
     elif entry.get("content"):
-        text = entry.content[0].get("value", "")
+        text = entry["content"][0].get("value", "")
 
-    # Strip basic HTML tags
-    text = re.sub(r"<[^>]+>", " ", text)
-    text = re.sub(r"\s+", " ", text).strip()
+    # Strip basic HTML tags and normalise whitespace
+    text = _STRIP_RE.sub(" ", text).strip()
     return text[:max_chars]
 
 
-def main():
-    sb = get_supabase()
-
-    socket.setdefaulttimeout(10)
-    log.info("Fetching active feeds from Supabase…")
-    feeds = fetch_all_active_feeds(sb)
-    log.info(f"Found {len(feeds)} active feed(s)")
-
-    if not feeds:
-        log.info("Nothing to do.")
-        return
-
-    existing_urls = fetch_existing_urls(sb)
-    log.info(f"{len(existing_urls)} items already in database")
-
-    # First pass: collect all candidate entries so we can compute
-    # multi-source correlation (same URL appearing in multiple feeds)
-    url_feed_count: dict[str, int] = {}
-    all_candidates: list[tuple[dict, dict, dict]] = []  # (entry, feed, parsed_feed)
+def fetch_one(http: httpx.Client, feed: dict, cutoff_ts: int) -> tuple[list[tuple[dict, dict]], dict | None]:
+    """Fetch and parse one feed.
 
-    cutoff = datetime.now(timezone.utc) - timedelta(days=MAX_AGE_DAYS)
+    Returns its recent (entry, feed) rows plus the feed's metadata update
+    (cache validators; None if the fetch failed). Sends the stored ETag /
+    Last-Modified so unchanged feeds come back as a bodiless 304. Documents
+    lxml cannot handle are parsed with feedparser instead.
+    """
+    log.info(f"Fetching: {feed['name']} ({feed['url']})")
+    headers = {}
+    if feed.get("etag"):
+        headers["If-None-Match"] = feed["etag"]
+    if feed.get("last_modified"):
+        headers["If-Modified-Since"] = feed["last_modified"]
 
-    for feed in feeds:
-        log.info(f"Fetching: {feed['name']} ({feed['url']})")
-        try:
-            parsed = feedparser.parse(feed["url"], request_headers={"User-Agent": "RSSKing/1.0"})
-        except Exception as e:
-            log.warning(f"  Failed to fetch {feed['url']}: {e}")
-            continue
+    try:
+        resp = http.get(feed["url"], headers=headers)
+        if resp.status_code != 304:
+            resp.raise_for_status()
+    except Exception as e:
+        log.warning(f"  Failed to fetch {feed['url']}: {e}")
+        return [], None
+
+    feed_update = {
+        "id":            feed["id"],
+        "etag":          resp.headers.get("etag"),
+        "last_modified": resp.headers.get("last-modified"),
+    }
+    if resp.status_code == 304:
+        log.info(f"  Not modified: {feed['name']}")
+        # A 304 may omit the validators; keep the stored ones in that case
+        feed_update["etag"]          = feed_update["etag"] or feed.get("etag")
+        feed_update["last_modified"] = feed_update["last_modified"] or feed.get("last_modified")
+        return [], feed_update
 
-        entries = parsed.entries[: feed.get("max_items", 10)]
-        for entry in entries:
-            url = entry.get("link", "").strip()
+    try:
+        entries = parse_feed_fast(resp.content, base_url=str(resp.url))
+        if entries is None:
+            log.info(f"  Falling back to feedparser for {feed['name']}")
+            entries = feedparser.parse(
+                resp.content,
+                response_headers={"content-location": str(resp.url)},
+            ).entries
+
+        rows = []
+        for entry in entries[: feed.get("max_items", 10)]:
+            url = normalise_url(entry.get("link", ""))
             if not url:
                 continue
+            entry["link"]     = url
+            entry["_url_key"] = url_key(url)
 
-            published = parse_published(entry)
-            entry["_published_dt"] = published
+            published_ts = parse_published(entry)
+            entry["_published_ts"] = published_ts
 
             # Skip if too old
-            if published and published < cutoff:
+            if published_ts is not None and published_ts < cutoff_ts:
                 continue
 
-            url_feed_count[url] = url_feed_count.get(url, 0) + 1
-            all_candidates.append((entry, feed, parsed))
+            rows.append((entry, feed))
+    except Exception as e:
+        log.warning(f"  Failed to parse {feed['url']}: {e}")
+        return [], None
 
-    # Second pass: score and collect new items
-    new_items: list[dict] = []
-    seen_urls: set[str] = set()
+    return rows, feed_update
+
+
+def save_feed_metadata(sb: Client, updates: list[dict]):
+    """Store cache validators and last_fetched_at for every fetched feed in a
+    single UPDATE, however many feeds there are."""
+    if not updates:
+        return
+    try:
+        sb.rpc("update_feed_metadata", {"updates": updates}).execute()
+        log.info(f"Updated metadata for {len(updates)} feed(s)")
+    except Exception as e:
+        log.warning(f"Feed metadata update error (non-fatal): {e}")
 
-    for entry, feed, parsed in all_candidates:
-        url = entry.get("link", "").strip()
 
-        # Skip duplicates already in DB or seen in this run
-        if url in existing_urls or url in seen_urls:
-            continue
-        seen_urls.add(url)
+def main():
+    sb = get_supabase()
 
-        published = entry.get("_published_dt")
-        score     = score_item(entry, feed, url_feed_count)
+    log.info("Fetching active feeds from Supabase…")
+    feeds = fetch_all_active_feeds(sb)
+    log.info(f"Found {len(feeds)} active feed(s)")
+
+    if not feeds:
+        log.info("Nothing to do.")
+        return
+
+    # Fetch phase: stream each feed's rows into the multi-source counter and a
+    # single best candidate per URL (from the highest-tier feed carrying it),
+    # so the full candidate list across all feeds is never held at once.
+    url_feed_count: dict[int, int] = {}      # url_key -> number of feeds carrying it
+    best: dict[int, tuple[dict, dict]] = {}  # url_key -> (entry, feed)
+    feed_updates: list[dict] = []
+
+    now_ts    = time.time()
+    cutoff_ts = int(now_ts) - MAX_AGE_DAYS * 86400
+
+    # One pooled client so connections (TCP + TLS) are reused per host
+    with httpx.Client(
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+        headers={"User-Agent": USER_AGENT},
+    ) as http, ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        # Merged on the main thread, in feed order, so no locking is needed
+        for rows, feed_update in ex.map(lambda f: fetch_one(http, f, cutoff_ts), feeds):
+            if feed_update:
+                feed_updates.append(feed_update)
+            for entry, feed in rows:
+                key = entry["_url_key"]
+                url_feed_count[key] = url_feed_count.get(key, 0) + 1
+                current = best.get(key)
+                if current is None or (
+                    TIER_WEIGHTS.get(feed.get("tier", 2), 20)
+                    > TIER_WEIGHTS.get(current[1].get("tier", 2), 20)
+                ):
+                    best[key] = (entry, feed)
+
+    # Score phase: one pass over the unique URLs, now that counts are final
+    new_items: list[dict] = []
+
+    for entry, feed in best.values():
+        url          = entry["link"]
+        published_ts = entry["_published_ts"]
+        score        = score_item(entry, feed, url_feed_count, now_ts)
 
         new_items.append({
             "feed_id":      feed["id"],
             "title":        (entry.get("title") or "").strip()[:500],
             "url":          url,
             "summary":      summarise(entry),
-            "published_at": published.isoformat() if published else None,
+            "published_at": (
+                datetime.fromtimestamp(published_ts, timezone.utc).isoformat()
+                if published_ts is not None else None
+            ),
             "score":        score,
             "category":     feed.get("category", "Uncategorized"),
             "source_name":  feed.get("name", ""),
         })
 
-    log.info(f"{len(new_items)} new item(s) to insert")
+    log.info(f"{len(new_items)} candidate item(s) to upsert")
 
     if not new_items:
+        save_feed_metadata(sb, feed_updates)
         log.info("No new items. Done.")
         return
 
-    # Batch insert in chunks of 100
-    chunk_size = 100
+    # Batch insert in chunks of 500. URLs already in the table are skipped by
+    # Postgres (ON CONFLICT (url) DO NOTHING), so no up-front lookup is needed
+    # and overlapping fetcher runs cannot insert duplicates.
+    chunk_size = 500
     inserted = 0
+    failed   = False
     for i in range(0, len(new_items), chunk_size):
         chunk = new_items[i : i + chunk_size]
         try:
-            sb.table("items").insert(chunk).execute()
-            inserted += len(chunk)
-            log.info(f"  Inserted {inserted}/{len(new_items)}")
+            res = sb.table("items") \
+                .upsert(chunk, on_conflict="url", ignore_duplicates=True) \
+                .execute()
+            inserted += len(res.data or [])
+            log.info(f"  Inserted {inserted} new of {min(i + chunk_size, len(new_items))} sent")
         except Exception as e:
+            failed = True
             log.error(f"  Insert error: {e}")
 
+    # Only advance the feeds' cache validators once their items are stored;
+    # otherwise the next run would get a 304 and never retry the lost entries.
+    if failed:
+        log.warning("Not updating feed metadata because an insert failed; feeds will be re-fetched in full next run")
+    else:
+        save_feed_metadata(sb, feed_updates)
+
     log.info(f"Done. {inserted} new item(s) written to Supabase.")
 
     # Clean up items older than MAX_AGE_DAYS (also delete items with no publish date
     # older than MAX_AGE_DAYS based on fetched_at as a fallback)
-    old_cutoff = (datetime.now(timezone.utc) - timedelta(days=MAX_AGE_DAYS)).isoformat()
+    old_cutoff = datetime.fromtimestamp(cutoff_ts, timezone.utc).isoformat()
     try:
-        sb.table("items").delete().lt("published_at", old_cutoff).execute()
-        sb.table("items").delete().is_("published_at", "null").lt("fetched_at", old_cutoff).execute()
-        log.info("Old items cleaned up.")
+        res = sb.rpc("purge_old_items", {"cutoff": old_cutoff}).execute()
+        log.info(f"Old items cleaned up ({res.data or 0} removed).")
     except Exception as e:
         log.warning(f"Cleanup error (non-fatal): {e}")
 
@@ -0,0 +1,112 @@
+-- =============================================================
+-- RSSKING migration: fetcher + digest performance work
+-- For projects created from an earlier schema.sql. Safe to re-run.
+-- Fresh projects get all of this from schema.sql directly.
+-- =============================================================
+
+
+-- =============================================================
+-- 1. FEEDS — HTTP cache validators and fetch bookkeeping
+-- =============================================================
+alter table public.feeds add column if not exists etag            text;
+alter table public.feeds add column if not exists last_modified   text;
+alter table public.feeds add column if not exists last_fetched_at timestamptz;
+
+create or replace function public.update_feed_metadata(updates jsonb)
+returns void as $$
+  update public.feeds f
+     set etag            = u.etag,
+         last_modified   = u.last_modified,
+         last_fetched_at = now()
+    from jsonb_to_recordset(updates) as u(id uuid, etag text, last_modified text)
+   where f.id = u.id;
+$$ language sql;
+
+revoke execute on function public.update_feed_metadata(jsonb) from public, anon, authenticated;
+
+
+-- =============================================================
+-- 2. ITEMS — upsert dedup and single-statement purge
+-- items.url is already unique (the fetcher's ON CONFLICT (url)
+-- relies on that constraint); the plain url index is redundant.
+-- =============================================================
+drop index if exists public.items_url_idx;
+create index if not exists items_purge_idx on public.items((coalesce(published_at, fetched_at)));
+
+create or replace function public.purge_old_items(cutoff timestamptz)
+returns int as $$
+  with deleted as (
+    delete from public.items
+     where coalesce(published_at, fetched_at) < cutoff
+    returning 1
+  )
+  select count(*)::int from deleted;
+$$ language sql;
+
+revoke execute on function public.purge_old_items(timestamptz) from public, anon, authenticated;
+
+
+-- =============================================================
+-- 3. USER STATE — recent stars for the digest payload
+-- =============================================================
+create index if not exists user_state_starred_idx on public.user_state(user_id, updated_at desc) where starred;
+
+
+-- =============================================================
+-- 4. CLAUDE CACHE
+-- =============================================================
+create table if not exists public.claude_cache (
+  prompt_sha256  text primary key,
+  response_json  jsonb not null,
+  created_at     timestamptz not null default now()
+);
+
+alter table public.claude_cache enable row level security;
+
+create index if not exists claude_cache_created_at_idx on public.claude_cache(created_at);
+
+
+-- =============================================================
+-- 5. DIGEST PAYLOAD
+-- =============================================================
+create or replace function public.get_digest_payload(
+  hours          int,
+  max_articles   int,
+  starred_limit  int
+)
+returns jsonb as $$
+  select coalesce(jsonb_agg(jsonb_build_object(
+    'user_id', u.user_id,
+    'profile', coalesce(to_jsonb(p), '{}'::jsonb),
+    'items', coalesce((
+      select jsonb_agg(to_jsonb(r) order by r.score desc)
+        from (
+          select i.id, i.title, i.url, i.summary, i.source_name,
+                 i.category, i.score, i.published_at
+            from public.items i
+            join public.feeds f on f.id = i.feed_id
+           where f.user_id = u.user_id
+             and f.active
+             and i.published_at >= now() - make_interval(hours => get_digest_payload.hours)
+           order by i.score desc
+           limit max_articles
+        ) r
+    ), '[]'::jsonb),
+    'starred', coalesce((
+      select jsonb_agg(jsonb_build_object('title', it.title) order by s.updated_at desc)
+        from (
+          select us.item_id, us.updated_at
+            from public.user_state us
+           where us.user_id = u.user_id
+             and us.starred
+           order by us.updated_at desc
+           limit starred_limit
+        ) s
+        join public.items it on it.id = s.item_id
+    ), '[]'::jsonb)
+  )), '[]'::jsonb)
+  from (select distinct user_id from public.feeds where active) u
+  left join public.user_profiles p on p.user_id = u.user_id;
+$$ language sql stable;
+
+revoke execute on function public.get_digest_payload(int, int, int) from public, anon, authenticated;
@@ -1,6 +1,7 @@
 -- =============================================================
 -- RSSKING Schema
 -- Run this in the Supabase SQL editor (once, on a fresh project)
+-- Existing projects: apply the files in supabase/migrations/ instead
 -- =============================================================
 
 
@@ -17,6 +18,9 @@ create table public.feeds (
   max_items   int  not null default 10,
   tier        int  not null default 2,  -- 1 = curated/editorial, 2 = standard
   active      bool not null default true,
+  etag          text,  -- HTTP cache validators from the last fetch,
+  last_modified text,  -- sent back so unchanged feeds return 304
+  last_fetched_at timestamptz,  -- last successful fetch (200 or 304)
   created_at  timestamptz not null default now()
 );
 
@@ -28,6 +32,21 @@ create policy "Users can manage their own feeds"
   using  (auth.uid() = user_id)
   with check (auth.uid() = user_id);
 
+-- Bulk-store per-feed fetch metadata written by the fetcher.
+-- updates: [{id, etag, last_modified}, ...] — one statement for all feeds;
+-- every listed feed is stamped as fetched now.
+create or replace function public.update_feed_metadata(updates jsonb)
+returns void as $$
+  update public.feeds f
+     set etag            = u.etag,
+         last_modified   = u.last_modified,
+         last_fetched_at = now()
+    from jsonb_to_recordset(updates) as u(id uuid, etag text, last_modified text)
+   where f.id = u.id;
+$$ language sql;
+
+revoke execute on function public.update_feed_metadata(jsonb) from public, anon, authenticated;
+
 
 -- =============================================================
 -- 2. ITEMS
@@ -62,7 +81,22 @@ create policy "Authenticated users can read items"
 create index items_feed_id_idx        on public.items(feed_id);
 create index items_published_at_idx   on public.items(published_at desc);
 create index items_score_idx          on public.items(score desc);
-create index items_url_idx            on public.items(url);
+-- (url lookups and the fetcher's ON CONFLICT (url) use the unique constraint's index)
+create index items_purge_idx          on public.items((coalesce(published_at, fetched_at)));
+
+-- Delete items older than cutoff in one statement (publish date, or fetch
+-- date when the feed gave none). Returns the number of rows removed.
+create or replace function public.purge_old_items(cutoff timestamptz)
+returns int as $$
+  with deleted as (
+    delete from public.items
+     where coalesce(published_at, fetched_at) < cutoff
+    returning 1
+  )
+  select count(*)::int from deleted;
+$$ language sql;
+
+revoke execute on function public.purge_old_items(timestamptz) from public, anon, authenticated;
 
 
 -- =============================================================
@@ -90,6 +124,8 @@ create policy "Users can manage their own state"
 
 create index user_state_user_id_idx on public.user_state(user_id);
 create index user_state_item_id_idx on public.user_state(item_id);
+-- Recent stars per user (digest interest signal in get_digest_payload)
+create index user_state_starred_idx on public.user_state(user_id, updated_at desc) where starred;
 
 
 -- =============================================================
@@ -151,3 +187,71 @@ create policy "Users can read their own digests"
 
 create index digests_user_id_generated_at_idx
   on public.digests(user_id, generated_at desc);
+
+
+-- =============================================================
+-- 6. CLAUDE CACHE
+-- Claude responses keyed by SHA-256 of model + prompt, so a
+-- re-run or retry of digest.py within the TTL skips the API call.
+-- Service role only (RLS on, no policies).
+-- =============================================================
+create table public.claude_cache (
+  prompt_sha256  text primary key,
+  response_json  jsonb not null,
+  created_at     timestamptz not null default now()
+);
+
+alter table public.claude_cache enable row level security;
+
+-- digest.py deletes rows past the TTL at the end of each run
+create index claude_cache_created_at_idx on public.claude_cache(created_at);
+
+
+-- =============================================================
+-- 7. DIGEST PAYLOAD
+-- Everything digest.py needs in one round-trip: one element per
+-- user with an active feed, carrying their profile, top-scored
+-- recent items and recently starred titles.
+-- =============================================================
+-- Returns: [{user_id, profile, items: [...], starred: [{title}]}, ...]
+create or replace function public.get_digest_payload(
+  hours          int,
+  max_articles   int,
+  starred_limit  int
+)
+returns jsonb as $$
+  select coalesce(jsonb_agg(jsonb_build_object(
+    'user_id', u.user_id,
+    'profile', coalesce(to_jsonb(p), '{}'::jsonb),
+    'items', coalesce((
+      select jsonb_agg(to_jsonb(r) order by r.score desc)
+        from (
+          select i.id, i.title, i.url, i.summary, i.source_name,
+                 i.category, i.score, i.published_at
+            from public.items i
+            join public.feeds f on f.id = i.feed_id
+           where f.user_id = u.user_id
+             and f.active
+             and i.published_at >= now() - make_interval(hours => get_digest_payload.hours)
+           order by i.score desc
+           limit max_articles
+        ) r
+    ), '[]'::jsonb),
+    'starred', coalesce((
+      select jsonb_agg(jsonb_build_object('title', it.title) order by s.updated_at desc)
+        from (
+          select us.item_id, us.updated_at
+            from public.user_state us
+           where us.user_id = u.user_id
+             and us.starred
+           order by us.updated_at desc
+           limit starred_limit
+        ) s
+        join public.items it on it.id = s.item_id
+    ), '[]'::jsonb)
+  )), '[]'::jsonb)
+  from (select distinct user_id from public.feeds where active) u
+  left join public.user_profiles p on p.user_id = u.user_id;
+$$ language sql stable;
+
+revoke execute on function public.get_digest_payload(int, int, int) from public, anon, authenticated;